@@ -0,0 +1,107 @@
+"""Startup benchmark.
+
+Compares the pykemen managers of a baseline git revision with the ones of
+the working tree: the time to import them, and the time of create_api with
+a cold and a warm discovery document cache. Every measure runs in a fresh
+interpreter. create_api is timed with a dummy oauth credentials file, so
+no token is requested, but the discovery documents are downloaded.
+
+Usage:
+    python benchmarks/import_time.py BASELINE_REVISION [runs]
+"""
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+
+IMPORT = ("import pykemen.google.analytics_manager, pykemen.google.mail_manager, "
+          "pykemen.google.bigquery_manager")
+CREATE_API_SETUP = "from pykemen.utilities import create_api"
+CREATE_API = ("create_api('analytics', 'v3', ['https://www.googleapis.com/auth/analytics'], "
+              "'unused', {credentials!r})")
+CREDENTIALS = ("from oauth2client import client; from pykemen.utilities import saveJson; "
+               "saveJson({credentials!r}, client.OAuth2Credentials("
+               "'token', 'id', 'secret', 'refresh', None, 'https://oauth2.googleapis.com/token', None).to_json())")
+TIMER = "{setup}; import time; start = time.time(); {statement}; print(time.time() - start)"
+
+
+def run(statement, path, env=None):
+    """Run a statement in a fresh interpreter with the pykemen package of path."""
+    environment = dict(os.environ, PYTHONPATH=path)
+    environment.update(env or {})
+    return subprocess.check_output(
+        [sys.executable, "-c", statement], cwd=path, env=environment, stderr=subprocess.STDOUT)
+
+
+def measure(statement, path, runs, env_factory=dict, setup="pass"):
+    """Median time in seconds of a statement, run after an untimed setup, None if it fails."""
+    times = []
+    for _ in range(runs):
+        try:
+            output = run(TIMER.format(setup=setup, statement=statement), path, env_factory())
+        except subprocess.CalledProcessError as error:
+            print(error.output.decode("utf-8").strip().splitlines()[-1])
+            return None
+        times.append(float(output.decode("utf-8").strip().splitlines()[-1]))
+    times.sort()
+    return times[len(times) // 2]
+
+
+def extract(revision, directory):
+    """Extract the pykemen package of a git revision into directory."""
+    archive = subprocess.check_output(["git", "archive", "--format=tar", revision, "pykemen"], cwd=ROOT)
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+
+
+def report(name, elapsed):
+    if elapsed is None:
+        print("{:<32} not available".format(name))
+    else:
+        print("{:<32} {:8.1f} ms".format(name, elapsed * 1000))
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    revision = sys.argv[1]
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else RUNS
+    workdir = tempfile.mkdtemp()
+    try:
+        baseline = os.path.join(workdir, "baseline")
+        extract(revision, baseline)
+        credentials = os.path.join(workdir, "credentials.json")
+        warm_cache = os.path.join(workdir, "discovery")
+        create_api = CREATE_API.format(credentials=credentials)
+
+        def cold_env():
+            return {"PYKEMEN_DISCOVERY_CACHE": tempfile.mkdtemp(dir=workdir)}
+
+        def warm_env():
+            return {"PYKEMEN_DISCOVERY_CACHE": warm_cache}
+
+        report("import, baseline", measure(IMPORT, baseline, runs))
+        report("import, current", measure(IMPORT, ROOT, runs))
+        try:
+            run(CREDENTIALS.format(credentials=credentials), ROOT)
+            run(CREATE_API_SETUP + "; " + create_api, ROOT, warm_env())
+        except subprocess.CalledProcessError as error:
+            print(error.output.decode("utf-8").strip().splitlines()[-1])
+            for name in ("create_api, baseline", "create_api, cold cache", "create_api, warm cache"):
+                report(name, None)
+            return
+        report("create_api, baseline", measure(create_api, baseline, runs, setup=CREATE_API_SETUP))
+        report("create_api, cold cache", measure(create_api, ROOT, runs, cold_env, CREATE_API_SETUP))
+        report("create_api, warm cache", measure(create_api, ROOT, runs, warm_env, CREATE_API_SETUP))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
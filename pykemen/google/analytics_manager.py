@@ -11,12 +11,15 @@ import re
 import hashlib
 import logging
 import shutil
+import threading
 import uuid
-import pandas as pd
 from io import BytesIO
-from pykemen.utilities import create_api
+from pykemen.utilities import LazyModule, create_api
 from datetime import datetime, timedelta
-from googleapiclient.http import MediaFileUpload, HttpError, MediaIoBaseUpload
+
+pd = LazyModule("pandas")
+http = LazyModule("googleapiclient.http")
+errors = LazyModule("googleapiclient.errors")
 
 logger = logging.getLogger("Analytics")
 logger.setLevel(logging.WARNING)
@@ -135,9 +138,20 @@ class Analytics(object):
             "https://www.googleapis.com/auth/analytics",
             "https://www.googleapis.com/auth/analytics.manage.users",
             ]
-        self._analyticsService = create_api("analytics", "v3", scope, secrets, credentials)
+        self._api_args = ("analytics", "v3", scope, secrets, credentials)
+        self._service = None
+        self._service_lock = threading.Lock()
         self._uuid = uuid.uuid4()
 
+    @property
+    def _analyticsService(self):
+        """Analytics API client, built on first use."""
+        if self._service is None:
+            with self._service_lock:
+                if self._service is None:
+                    self._service = create_api(*self._api_args)
+        return self._service
+
     def get_report(self, unsampled=False, cache=True, **kwargs):
         """Downloads data from Analytics and caches the result. If the data is alredy cached, skips the
         download and directly returns an Analytics.AnalyticsReport.
@@ -156,7 +170,6 @@ class Analytics(object):
             kwargs.get("filters", ""),
             kwargs.get("segments", ""),
             ])
-        kwargs["quotaUser"] = self._uuid
         id_ = hashlib.md5(id_to_hash.encode('utf8')).hexdigest()
         start_date = kwargs.get('start_date')
         end_date = kwargs.get('end_date')
@@ -166,7 +179,6 @@ class Analytics(object):
         dtypes.update({metric: float for metric in kwargs.get("metrics", "").split(",")})
         rows = []
         data_frames = []
-        report = None
         if cache and not os.path.isdir(Analytics.CACHE_DIR.format(profile=kwargs.get('ids').replace('ga:', ''), id=id_)):
             os.makedirs(Analytics.CACHE_DIR.format(profile=kwargs.get('ids').replace('ga:', ''), id=id_))
         
@@ -178,45 +190,8 @@ class Analytics(object):
                 end_date=end_date
             )
             if not cache or not self._in_cache(kwargs.get('ids').replace('ga:', ''), id_, start_date, end_date):
-                qps = True
-                while qps:
-                    qps = False
-                    try:
-                        report = self._analyticsService.data().ga().get(**kwargs).execute()
-                    except HttpError as e:
-                        error_content = json.loads(e.content.decode("utf-8"))
-                        if error_content.get("error", {}).get("message") =="Rate Limit Exceeded":
-                            qps = True
-                            time.sleep(1)
-                            logger.warn("Rate limit excedeed!")
-                            logger.warn(e.content)
-                        else:
-                            logger.warn(e.content)
-                            raise e
-                if report.get('containSampledData'):
-                    logger.warn("There are sampled results on the report: {dimensions}{metrics} - date: {start_date} to {end_date}".format(
-                            dimensions=kwargs.get("dimensions"), metrics=kwargs.get("metrics"), start_date=start_date, end_date=end_date))
-                rows.extend(report.get('rows', []))
-                iteration = 1
-                while report.get('nextLink'):
-                    kwargs['start_index'] = 1 + kwargs.get('max_results', 1000) * iteration
-                    qps = True
-                    while qps:
-                        qps = False
-                        try:
-                            report = self._analyticsService.data().ga().get(**kwargs).execute()
-                        except HttpError as e:
-                            error_content = json.loads(e.content.decode("utf-8"))
-                            if error_content.get("error", {}).get("message") =="Rate Limit Exceeded":
-                                qps = True
-                                time.sleep(1)
-                                logger.warn("Rate limit excedeed!")
-                                logger.warn(e.content)
-                            else:
-                                logger.warn(e.content)
-                                raise e
+                for _, report in self.iter_report_pages(**kwargs):
                     rows.extend(report.get('rows', []))
-                    iteration += 1
                 df = pd.DataFrame(data=rows, columns=columns)
 
                 if cache:
@@ -231,48 +206,9 @@ class Analytics(object):
                 filename = Analytics.CACHE_UNSAMPLED_REPORT.format(profile=kwargs.get('ids').replace('ga:', ''), id=id_,
                                                         date=actualDate)
                 if  not cache or not self._in_cache_by_day(kwargs.get('ids').replace('ga:', ''), id_, actualDate):
-                    kwargs["start_date"] = actualDate
-                    kwargs["end_date"] = actualDate
-                    kwargs["start_index"] = 1
-                    qps = True
-                    while qps:
-                        qps = False
-                        try:
-                            report = self._analyticsService.data().ga().get(**kwargs).execute()
-                        except HttpError as e:
-                            error_content = json.loads(e.content.decode("utf-8"))
-                            if error_content.get("error", {}).get("message") =="Rate Limit Exceeded":
-                                qps = True
-                                time.sleep(1)
-                                logger.warn("Rate limit excedeed!")
-                                logger.warn(e.content)
-                            else:
-                                logger.warn(e.content)
-                                raise e
-                    if report.get("containsSampledData"):
-                        logger.warn("There are sampled results on the report: {dimensions}{metrics} - date{date}".format(
-                            dimensions=kwargs.get("dimensions"), metrics=kwargs.get("metrics"), date=actualDate))
-                    rows.extend(report.get("rows", []))
-                    iteration = 1
-                    while report.get("nextLink"):
-                        kwargs["start_index"] = 1 + kwargs.get('max_results', 1000) * iteration
-                        qps = True
-                        while qps:
-                            qps = False
-                            try:
-                                report = self._analyticsService.data().ga().get(**kwargs).execute()
-                            except HttpError as e:
-                                error_content = json.loads(e.content.decode("utf-8"))
-                                if error_content.get("error", {}).get("message") =="Rate Limit Exceeded":
-                                    qps = True
-                                    time.sleep(1)
-                                    logger.warn("Rate limit excedeed!")
-                                    logger.warn(e.content)
-                                else:
-                                    logger.warn(e.content)
-                                    raise e
+                    day_kwargs = dict(kwargs, start_date=actualDate, end_date=actualDate)
+                    for _, report in self.iter_report_pages(unsampled=True, **day_kwargs):
                         rows.extend(report.get("rows", []))
-                        iteration += 1
                     df = pd.DataFrame(data=rows, columns=columns)
                     data_frames.append(df)
                     if cache:
@@ -306,6 +242,63 @@ class Analytics(object):
             cache=cache
         )
 
+    def iter_report_pages(self, unsampled=False, **kwargs):
+        """Downloads a report from Analytics page by page, without caching it.
+
+        Args:
+            unsampled (boolean): True will download the report day by day to try get unsampled data.
+            kwargs (**dict): Analytics report configuration variable with all required parameters
+
+        Yields:
+            tuple: date of the page (%Y-%m-%d, None if not unsampled) and the raw Analytics response
+        """
+        kwargs["quotaUser"] = self._uuid
+        if unsampled:
+            startDate = datetime.strptime(kwargs.get("start_date"), "%Y-%m-%d")
+            endDate = datetime.strptime(kwargs.get("end_date"), "%Y-%m-%d")
+            dates = [(startDate + timedelta(days=day)).strftime("%Y-%m-%d")
+                     for day in range((endDate - startDate).days + 1)]
+        else:
+            dates = [None]
+        for date in dates:
+            if date:
+                kwargs["start_date"] = date
+                kwargs["end_date"] = date
+            kwargs["start_index"] = 1
+            report = self._get_data(kwargs)
+            if report.get("containsSampledData"):
+                logger.warn("There are sampled results on the report: {dimensions}{metrics} - date: {start_date} to {end_date}".format(
+                    dimensions=kwargs.get("dimensions"), metrics=kwargs.get("metrics"),
+                    start_date=kwargs.get("start_date"), end_date=kwargs.get("end_date")))
+            yield date, report
+            iteration = 1
+            while report.get("nextLink"):
+                kwargs["start_index"] = 1 + kwargs.get('max_results', 1000) * iteration
+                report = self._get_data(kwargs)
+                yield date, report
+                iteration += 1
+
+    def _get_data(self, kwargs):
+        """Query a page of a report, waiting while the rate limit is exceeded.
+
+        Args:
+            kwargs (dict): Analytics report configuration
+
+        Returns:
+            dict: Analytics response"""
+        while True:
+            try:
+                return self._analyticsService.data().ga().get(**kwargs).execute()
+            except errors.HttpError as e:
+                error_content = json.loads(e.content.decode("utf-8"))
+                if error_content.get("error", {}).get("message") =="Rate Limit Exceeded":
+                    time.sleep(1)
+                    logger.warn("Rate limit excedeed!")
+                    logger.warn(e.content)
+                else:
+                    logger.warn(e.content)
+                    raise e
+
     def data_import(self, accountId, webPropertyId, dataSourceId, filename=None, content=None):
         """Import a csv to Analytics through a data import.
 
@@ -320,9 +313,9 @@ class Analytics(object):
         if filename is None and content is None:
             raise Exception("In order to upload data, you have either to introduce a valid filename or a content.")
         if filename:
-            media = MediaFileUpload(filename, mimetype='application/octet-stream', resumable=False)
+            media = http.MediaFileUpload(filename, mimetype='application/octet-stream', resumable=False)
         else:
-            media = MediaIoBaseUpload(BytesIO(content.encode("utf-8")), mimetype='application/octet-stream', resumable=False)
+            media = http.MediaIoBaseUpload(BytesIO(content.encode("utf-8")), mimetype='application/octet-stream', resumable=False)
         response = self._analyticsService.management().uploads().uploadData(
             accountId=accountId,
             webPropertyId=webPropertyId,
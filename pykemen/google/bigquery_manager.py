@@ -5,9 +5,15 @@ of BigQuery that AudienceScore needs.
 """
 __author__ = 'Metriplica-Ayyoub&Javier'
 
+import re
+import threading
 import time
-from google.cloud import bigquery
-from google.api_core.exceptions import NotFound
+from datetime import date, datetime
+from multiprocessing.pool import ThreadPool
+from pykemen.utilities import LazyModule, POOL_SIZE, create_session
+
+bigquery = LazyModule("google.cloud.bigquery")
+exceptions = LazyModule("google.api_core.exceptions")
 
 class BigQuery(object):
     """BigQuery class.
@@ -15,17 +21,39 @@ class BigQuery(object):
     Manage bigQuery tables and properties.
     """
 
-    def __init__(self, project=None, location="US"):
+    METADATA_TTL = 300
+
+    def __init__(self, project=None, location="US", metadata_ttl=METADATA_TTL, pool_size=POOL_SIZE):
         """Init module initialize and create BigQuery class.
 
         Args:
-            credentials (dcit): Credentials to access to the client services
-            secrets (dict): Secrets of the Google accout to use
+            project (str): default BigQuery project of the client
+            location (str): default location of the jobs
+            metadata_ttl (int): seconds that cached table metadata is considered fresh
+            pool_size (int): HTTP connections kept alive for concurrent requests
 
         Returns:
             BigQuery: with given configuration.
         """
-        self.bigquery_client = bigquery.Client(project=project, location=location)
+        self._client_args = {"project": project, "location": location}
+        self._pool_size = pool_size
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.metadata_ttl = metadata_ttl
+        self._dataset_tables = {}
+        self._table_properties = {}
+        self._dataset_generations = {}
+        self._metadata_lock = threading.Lock()
+
+    @property
+    def bigquery_client(self):
+        """BigQuery client, created on first use."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = bigquery.Client(
+                        _http=create_session(bigquery.Client.SCOPE, self._pool_size), **self._client_args)
+        return self._client
 
     def create_table(self, project_id, dataset_id, table_id, query, legacy=True):
         """Create table function.
@@ -54,6 +82,7 @@ class BigQuery(object):
         while query_job.running():
             time.sleep(60)
         if query_job.done():
+            self._cache_table(project_id, dataset_id, table_id)
             return True
         elif query_job.cancelled():
             raise Exception("BigQuery table creation", query_job.errors)
@@ -84,7 +113,8 @@ class BigQuery(object):
             expiration_ms = expiration*24*60*60*1000 if expiration else None
             partitioning = bigquery.TimePartitioning(field=partition_field, expiration_ms=expiration_ms)
             table.time_partitioning = partitioning
-        table_ref = self.bigquery_client.create_table(table)
+        table = self.bigquery_client.create_table(table)
+        self._cache_table(project_id, dataset_id, table_id, table)
 
     @staticmethod
     def _get_schema_from_str(schema_str):
@@ -96,9 +126,8 @@ class BigQuery(object):
     
     @staticmethod
     def _get_schema_from_json(schema):
-        for field in schema:
-            field = bigquery.SchemaField.from_api_repr(field)
-        return schema
+        return [field if isinstance(field, bigquery.SchemaField) else bigquery.SchemaField.from_api_repr(field)
+                for field in schema]
        
     def overwrite_table(self, project_id, dataset_id, table_id, query, legacy=True):
         """Create table function.
@@ -126,6 +155,7 @@ class BigQuery(object):
         while query_job.running():
             time.sleep(60)
         if query_job.done():
+            self._cache_table(project_id, dataset_id, table_id)
             return True
         elif query_job.cancelled():
             raise Exception("BigQuery table creation", query_job.errors)
@@ -153,10 +183,188 @@ class BigQuery(object):
         while query_job.running():
             time.sleep(60)
         if query_job.done():
+            self._cache_table(project_id, dataset_id, table_id)
             return True
         elif query_job.cancelled():
             raise Exception("BigQuery table creation", query_job.errors)
 
+    def overwrite_partitions(self, project_id, dataset_id, table_id, queries, legacy=True, threads=4):
+        """Overwrite some partitions of a time partitioned table.
+
+        Each query is written to its own table$YYYYMMDD destination with
+        WRITE_TRUNCATE, so only the given partitions are replaced. The
+        queries run in parallel.
+
+        Args:
+            project_id (str): BigQuery project id
+            dataset_id (str): dataset of the table
+            table_id (str): partitioned table to write to
+            queries (dict): partition date (date, datetime, %Y-%m-%d or %Y%m%d) to query
+            legacy (bool): True to run the queries with legacy SQL
+            threads (int): maximum number of queries running at the same time
+
+        Returns:
+            bool: True for success, Raises an error otherwise.
+        """
+        dataset = self.bigquery_client.dataset(dataset_id, project_id)
+
+        def overwrite(item):
+            partition, query = item
+            query_job_config = bigquery.QueryJobConfig()
+            query_job_config.create_disposition = bigquery.CreateDisposition.CREATE_NEVER
+            query_job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+            query_job_config.destination = dataset.table(
+                "{table}${partition}".format(table=table_id, partition=self._partition_decorator(partition)))
+            query_job_config.use_legacy_sql = legacy
+            query_job_config.allow_large_results = True
+            return self._run_query(query, query_job_config)
+
+        pool = ThreadPool(max(1, min(threads, len(queries))))
+        try:
+            pool.map(overwrite, list(queries.items()))
+        finally:
+            pool.close()
+            pool.join()
+        self._cache_table(project_id, dataset_id, table_id)
+        return True
+
+    def merge_table(self, project_id, dataset_id, table_id, source, keys, columns=None, partitions=None):
+        """Upsert the result of a query into a table with a MERGE statement.
+
+        Rows of the source matching the keys are updated, the rest are inserted.
+        Giving the partitions restricts the target side of the MERGE to them, so
+        only those partitions are scanned and rewritten; in that case the source
+        rows should also belong to the given partitions. On ingestion time
+        partitioned tables the partitions are matched on _PARTITIONTIME, and
+        inserted rows go to the given partition, or to the _PARTITIONTIME
+        column of the source when several partitions are given.
+
+        Args:
+            project_id (str): BigQuery project id
+            dataset_id (str): dataset of the table
+            table_id (str): table to merge into
+            source (str): standard SQL query with the new rows
+            keys (list): columns identifying a row
+            columns (list): columns to update and insert, all the table columns by default
+            partitions (list): partition dates to restrict the merge to
+
+        Returns:
+            bool: True for success, Raises an error otherwise.
+        """
+        if not keys:
+            raise ValueError("At least one key column is required to merge into {}".format(table_id))
+        table = self.get_table_properties(project_id, dataset_id, table_id)
+        if columns is None:
+            columns = [field.name for field in table.schema]
+        condition = " AND ".join("T.`{key}` = S.`{key}`".format(key=key) for key in keys)
+        insert_columns = ["`{}`".format(column) for column in columns]
+        insert_values = ["S.`{}`".format(column) for column in columns]
+        if partitions:
+            if not table.time_partitioning:
+                raise ValueError("Filtering partitions requires a partitioned table: {}".format(table_id))
+            dates = ", ".join("DATE '{}'".format(self._partition_date(partition)) for partition in partitions)
+            if table.time_partitioning.field:
+                condition += " AND CAST(T.`{field}` AS DATE) IN ({dates})".format(
+                    field=table.time_partitioning.field, dates=dates)
+            else:
+                condition += " AND DATE(T._PARTITIONTIME) IN ({dates})".format(dates=dates)
+                insert_columns.insert(0, "_PARTITIONTIME")
+                if len(partitions) == 1:
+                    insert_values.insert(0, "TIMESTAMP('{}')".format(self._partition_date(partitions[0])))
+                else:
+                    insert_values.insert(0, "S._PARTITIONTIME")
+        updates = [column for column in columns if column not in keys]
+        query = (
+            "MERGE `{project}.{dataset}.{table}` T\n"
+            "USING ({source}) S\n"
+            "ON {condition}\n"
+        ).format(project=table.project, dataset=dataset_id, table=table_id, source=source, condition=condition)
+        if updates:
+            query += "WHEN MATCHED THEN UPDATE SET {}\n".format(
+                ", ".join("`{column}` = S.`{column}`".format(column=column) for column in updates))
+        query += "WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({values})".format(
+            columns=", ".join(insert_columns), values=", ".join(insert_values))
+        query_job_config = bigquery.QueryJobConfig()
+        query_job_config.use_legacy_sql = False
+        self._run_query(query, query_job_config, project=project_id)
+        self._cache_table(project_id, dataset_id, table_id)
+        return True
+
+    def load_json(self, project_id, dataset_id, table_id, data, schema, partition=None, append=False):
+        """Load newline delimited JSON into a table or a partition of it.
+
+        If the table does not exist it is created with the given schema,
+        partitioned by ingestion time when a partition is given.
+
+        Args:
+            project_id (str): BigQuery project id
+            dataset_id (str): dataset of the table
+            table_id (str): table to load the data to
+            data (file): binary file object with newline delimited JSON rows
+            schema (list): bigquery.SchemaField list, or a schema accepted by create_empty_table
+            partition (date): partition to write to, the whole table if None
+            append (bool): True to append the rows, False to overwrite the table or partition
+
+        Returns:
+            bool: True for success, Raises an error otherwise.
+        """
+        if isinstance(schema, list):
+            schema = self._get_schema_from_json(schema)
+        elif isinstance(schema, str):
+            schema = self._get_schema_from_str(schema)
+        destination = table_id
+        if partition:
+            destination = "{table}${partition}".format(table=table_id, partition=self._partition_decorator(partition))
+        load_job_config = bigquery.LoadJobConfig()
+        load_job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        load_job_config.schema = schema
+        load_job_config.create_disposition = bigquery.CreateDisposition.CREATE_IF_NEEDED
+        if append:
+            load_job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        else:
+            load_job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        if partition and not self.is_table_created(project_id, dataset_id, table_id):
+            load_job_config.time_partitioning = bigquery.TimePartitioning()
+        load_job = self.bigquery_client.load_table_from_file(
+            data,
+            self.bigquery_client.dataset(dataset_id, project_id).table(destination),
+            rewind=True,
+            job_config=load_job_config)
+        load_job.result()
+        self._cache_table(project_id, dataset_id, table_id)
+        return True
+
+    def _run_query(self, query, job_config, project=None):
+        """Run a query job and wait for it to finish.
+
+        Returns:
+            bool: True for success, Raises an error otherwise.
+        """
+        query_job = self.bigquery_client.query(query, job_config, project=project)
+        query_job.result()
+        if query_job.cancelled():
+            raise Exception("BigQuery query", query_job.errors)
+        return True
+
+    @staticmethod
+    def _partition_decorator(partition):
+        """Format a partition date as the YYYYMMDD table decorator."""
+        if isinstance(partition, (date, datetime)):
+            return partition.strftime("%Y%m%d")
+        for pattern, date_format in ((r"\d{4}-\d{2}-\d{2}$", "%Y-%m-%d"), (r"\d{8}$", "%Y%m%d")):
+            if re.match(pattern, partition):
+                try:
+                    return datetime.strptime(partition, date_format).strftime("%Y%m%d")
+                except ValueError:
+                    break
+        raise ValueError("Partition {} is not a %Y-%m-%d or %Y%m%d date".format(partition))
+
+    @staticmethod
+    def _partition_date(partition):
+        """Format a partition date as %Y-%m-%d."""
+        decorator = BigQuery._partition_decorator(partition)
+        return "{}-{}-{}".format(decorator[:4], decorator[4:6], decorator[6:])
+
     def delete_table(self, project_id, dataset_id, table_id):
         """Delete table function.
 
@@ -171,8 +379,9 @@ class BigQuery(object):
 
         """
 
-        table = self.bigquery_client.dataset(dataset_id).table(table_id)
+        table = self.bigquery_client.dataset(dataset_id, project_id).table(table_id)
         self.bigquery_client.delete_table(table)
+        self._uncache_table(project_id, dataset_id, table_id)
         return True
 
     def save_query2csv(self, filename, project_id, query, header=None, delimiter=',', legacy=True):
@@ -207,6 +416,9 @@ class BigQuery(object):
     def is_table_created(self, project_id, dataset_id, table_id):
         """Check if the specified table is created.
 
+        The check is answered from the dataset table listing, which is
+        fetched with a single list_tables call and cached for metadata_ttl seconds.
+
         Args:
             tableId   (str):  Table name to Check.
 
@@ -214,12 +426,77 @@ class BigQuery(object):
             bool: True if exists, false otherwhise.
 
         """
-        try:
-            table_ref = self.bigquery_client.dataset(dataset_id, project_id).table(table_id)
-            table = self.bigquery_client.get_table(table_ref)
-            return True
-        except NotFound:  # noqa
-            return False
+        return table_id in self.list_tables(project_id, dataset_id)
+
+    def list_tables(self, project_id, dataset_id, refresh=False):
+        """List the table ids of a dataset, using the metadata cache.
+
+        Args:
+            project_id (str): BigQuery project id
+            dataset_id (str): dataset to list
+            refresh (bool): True to skip the cache and list the dataset again
+
+        Returns:
+            frozenset: table ids of the dataset, empty if the dataset does not exist.
+        """
+        key = (project_id or self.bigquery_client.project, dataset_id)
+        with self._metadata_lock:
+            cached = self._dataset_tables.get(key)
+        if not refresh and cached and time.time() - cached[0] < self.metadata_ttl:
+            return cached[1]
+        dataset_ref = self.bigquery_client.dataset(dataset_id, project_id)
+        while True:
+            # Tables created or deleted by this class while listing make the listing out of date.
+            with self._metadata_lock:
+                generation = self._dataset_generations.get(key, 0)
+            try:
+                tables = frozenset(table.table_id for table in self.bigquery_client.list_tables(dataset_ref))
+            except exceptions.NotFound:  # noqa
+                tables = frozenset()
+            with self._metadata_lock:
+                if self._dataset_generations.get(key, 0) == generation:
+                    self._dataset_tables[key] = (time.time(), tables)
+                    return tables
+
+    def clear_metadata_cache(self, project_id=None, dataset_id=None):
+        """Drop cached table metadata.
+
+        Args:
+            project_id (str): project to clear, all projects if None
+            dataset_id (str): dataset to clear, all datasets of the project if None
+        """
+        def matches(key):
+            return project_id in (None, key[0]) and dataset_id in (None, key[1])
+
+        with self._metadata_lock:
+            for cache in (self._dataset_tables, self._table_properties):
+                for key in [key for key in cache if matches(key)]:
+                    del cache[key]
+
+    def _cache_table(self, project_id, dataset_id, table_id, table=None):
+        """Register a table created by this class in the metadata cache."""
+        project_id = project_id or self.bigquery_client.project
+        with self._metadata_lock:
+            self._dataset_generations[(project_id, dataset_id)] = self._dataset_generations.get(
+                (project_id, dataset_id), 0) + 1
+            cached = self._dataset_tables.get((project_id, dataset_id))
+            if cached:
+                self._dataset_tables[(project_id, dataset_id)] = (cached[0], cached[1] | frozenset([table_id]))
+            if table is None:
+                self._table_properties.pop((project_id, dataset_id, table_id), None)
+            else:
+                self._table_properties[(project_id, dataset_id, table_id)] = (time.time(), table)
+
+    def _uncache_table(self, project_id, dataset_id, table_id):
+        """Remove a table deleted by this class from the metadata cache."""
+        project_id = project_id or self.bigquery_client.project
+        with self._metadata_lock:
+            self._dataset_generations[(project_id, dataset_id)] = self._dataset_generations.get(
+                (project_id, dataset_id), 0) + 1
+            cached = self._dataset_tables.get((project_id, dataset_id))
+            if cached:
+                self._dataset_tables[(project_id, dataset_id)] = (cached[0], cached[1] - frozenset([table_id]))
+            self._table_properties.pop((project_id, dataset_id, table_id), None)
 
     def get_table_properties(self, project_id, dataset_id, table_id):
         """Get properties of a bigQuery table.
@@ -231,16 +508,18 @@ class BigQuery(object):
             fields (str): Requested properties
 
         Returs:
-            dict: Json with the specified properties.
+            bigquery.Table: the table, cached for metadata_ttl seconds.
 
         """
+        key = (project_id or self.bigquery_client.project, dataset_id, table_id)
+        with self._metadata_lock:
+            cached = self._table_properties.get(key)
+        if cached and time.time() - cached[0] < self.metadata_ttl:
+            return cached[1]
         table_ref = self.bigquery_client.dataset(dataset_id, project_id).table(table_id)
-        return self.bigquery_client.get_table(table_ref)
-        return self._bigqueryService.tables().get(
-            projectId=project_id,
-            datasetId=dataset_id,
-            tableId=table_id
-        ).execute()
+        table = self.bigquery_client.get_table(table_ref)
+        self._cache_table(project_id, dataset_id, table_id, table)
+        return table
 
     def create_dataset(self, project_id, dataset_id, location):
         """Create a dataset in the specified project.
@@ -6,9 +6,23 @@ of Mail that AudienceScore needs.
 __author__ = 'Metriplica-Ayyoub&Javier'
 
 import base64
+import binascii
+import json
+import mimetypes
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 import pykemen.utilities as utilities
+from io import BytesIO
+from email.message import Message
 from email.mime.text import MIMEText
-from apiclient import errors  # noqa
+
+errors = utilities.LazyModule("googleapiclient.errors")
+http = utilities.LazyModule("googleapiclient.http")
 
 
 class Mail(object):
@@ -16,13 +30,24 @@ class Mail(object):
 
     Useful to send messages form the specified account.
     """
+    BATCH_SIZE = 50
+    SEND_QUOTA_UNITS = 100
+    QUOTA_UNITS_PER_SECOND = 250
+    QUOTA_BURST_UNITS = 250
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    RETRY_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "backendError")
+    FATAL_REASONS = ("dailyLimitExceeded",)
+    READ_CHUNK_SIZE = 57 * 1024
+    UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
 
-    def __init__(self, secrets, credentials):
+    def __init__(self, secrets, credentials, quota_burst_units=QUOTA_BURST_UNITS):
         """Init module initialize and create Mail class.
 
         Args:
             credentials (str): Credentials to access to the client services
             secrets (str): Secrets of the Google accout to use
+            quota_burst_units (int): Gmail quota units that may be spent at once, it limits
+                send_bulk batches to quota_burst_units // SEND_QUOTA_UNITS messages
 
         Returns:
             Mail: with given configuration.
@@ -32,32 +57,232 @@ class Mail(object):
             "https://www.googleapis.com/auth/bigquery", 
             "https://www.googleapis.com/auth/bigquery.insertdata",
             ]
-        self._gmailService = utilities.create_api('gmail', 'v1', scopes, secrets, credentials)
+        self._api_args = ('gmail', 'v1', scopes, secrets, credentials)
+        self._service = None
+        self._service_lock = threading.Lock()
+        self._rateLimiter = utilities.TokenBucket(Mail.QUOTA_UNITS_PER_SECOND, quota_burst_units)
+
+    @property
+    def _gmailService(self):
+        """Gmail API client, built on first use."""
+        if self._service is None:
+            with self._service_lock:
+                if self._service is None:
+                    self._service = utilities.create_api(*self._api_args)
+        return self._service
 
-    def _createMessage(self, to, subject, body, type='plain'):
+    def _createMessage(self, to, subject, body, type='plain', attachments=None, compress=False):
         """Create a message object."""
+        if attachments:
+            message = BytesIO()
+            self._writeMessage(message, to, subject, body, type, attachments, compress)
+            return {'raw': base64.urlsafe_b64encode(message.getvalue()).decode('ascii')}
         message = MIMEText(body, type)
         message['to'] = ','.join(to)
         message['from'] = 'me'
         message['subject'] = subject
-        return {'raw': base64.urlsafe_b64encode(message.as_string())}
+        return {'raw': base64.urlsafe_b64encode(message.as_string().encode('utf-8')).decode('ascii')}
 
-    def sendMessage(self, to, subject, message, type='plain'):
+    def sendMessage(self, to, subject, message, type='plain', attachments=None, compress=False):
         """Send a message to specified reciver.
 
+        Messages with attachments are written to a temporary file and sent
+        through a resumable media upload, so attachments are never fully
+        loaded in memory.
+
         Args:
             to (list): Recivers of the email separated by comma
             subject (str): subject of the email
             message (str): message or body of the email
+            attachments (list): file paths, or (filename, source) tuples where source is
+                a file path, bytes, a binary file object, a pd.DataFrame or an Analytics.AnalyticsReport.
+                On Python 2 a str is always taken as a path, pass raw content as a bytearray or BytesIO.
+            compress (bool): True to gzip the attachments
 
         Returns:
             int: message id.
 
         """
         try:
+            if attachments:
+                with tempfile.TemporaryFile() as objectMessage:
+                    self._writeMessage(objectMessage, to, subject, message, type, attachments, compress)
+                    media = http.MediaIoBaseUpload(objectMessage, mimetype='message/rfc822',
+                                              chunksize=Mail.UPLOAD_CHUNK_SIZE, resumable=True)
+                    self._rateLimiter.acquire(Mail.SEND_QUOTA_UNITS)
+                    return self._gmailService.users().messages().send(
+                        userId='me', body={}, media_body=media).execute()
             objectMessage = self._createMessage(to, subject, message, type)
+            self._rateLimiter.acquire(Mail.SEND_QUOTA_UNITS)
             messageId = self._gmailService.users().messages().send(
                 userId='me', body=objectMessage).execute()
             return messageId
         except errors.HttpError as error:
             raise Exception(error)
+
+    def _writeMessage(self, out, to, subject, body, type, attachments, compress):
+        """Write a multipart message to a binary file object, streaming the attachments."""
+        boundary = '===============' + uuid.uuid4().hex
+        headers = Message()
+        headers['to'] = ','.join(to)
+        headers['from'] = 'me'
+        headers['subject'] = subject
+        headers['MIME-Version'] = '1.0'
+        out.write(headers.as_string().rstrip('\n').encode('utf-8'))
+        out.write('\nContent-Type: multipart/mixed; boundary="{}"\n\n'.format(boundary).encode('ascii'))
+        out.write('--{}\n'.format(boundary).encode('ascii'))
+        out.write(MIMEText(body, type).as_string().encode('utf-8'))
+        for attachment in attachments:
+            filename, fileobj, cleanup = self._openAttachment(attachment)
+            try:
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                if compress:
+                    filename, mimetype = filename + '.gz', 'application/gzip'
+                part = Message()
+                part.add_header('Content-Type', mimetype, name=filename)
+                part['Content-Transfer-Encoding'] = 'base64'
+                part.add_header('Content-Disposition', 'attachment', filename=filename)
+                out.write('\n--{}\n'.format(boundary).encode('ascii'))
+                out.write(part.as_string().encode('utf-8'))
+                pending = b''
+                for chunk in self._readChunks(fileobj, compress):
+                    pending += chunk
+                    size = len(pending) - len(pending) % 57
+                    for start in range(0, size, 57):
+                        out.write(binascii.b2a_base64(pending[start:start + 57]))
+                    pending = pending[size:]
+                if pending:
+                    out.write(binascii.b2a_base64(pending))
+            finally:
+                cleanup()
+        out.write('\n--{}--\n'.format(boundary).encode('ascii'))
+        out.seek(0)
+
+    @staticmethod
+    def _readChunks(fileobj, compress):
+        """Read a file object in chunks, gzipping them if required."""
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        while True:
+            chunk = fileobj.read(Mail.READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            yield compressor.compress(chunk) if compressor else chunk
+        if compressor:
+            yield compressor.flush()
+
+    @staticmethod
+    def _openAttachment(attachment):
+        """Open an attachment for reading.
+
+        Returns:
+            tuple: filename, file object and a function that releases the file object
+        """
+        if isinstance(attachment, tuple):
+            filename, source = attachment
+        else:
+            filename, source = os.path.basename(attachment), attachment
+        if isinstance(source, (str, type(u''))):
+            fileobj = open(source, 'rb')
+            return filename, fileobj, fileobj.close
+        if isinstance(source, (bytes, bytearray)):
+            return filename, BytesIO(source), lambda: None
+        if hasattr(source, 'read'):
+            return filename, source, lambda: None
+        descriptor, path = tempfile.mkstemp(suffix='.csv')
+        os.close(descriptor)
+        if hasattr(source, 'to_data_frame'):
+            source.to_csv(path)
+        else:
+            source.to_csv(path, encoding='utf-8', index=False)
+        fileobj = open(path, 'rb')
+
+        def cleanup():
+            fileobj.close()
+            os.remove(path)
+        return filename, fileobj, cleanup
+
+    def send_bulk(self, messages, batch_size=BATCH_SIZE, retries=5):
+        """Send many messages grouped in batch requests.
+
+        Sending is throttled to the Gmail per user quota: the quota units of a
+        whole batch are taken right before it is sent, so a batch never holds
+        more than quota_burst_units // SEND_QUOTA_UNITS messages, 2 with the
+        default burst of one second of quota. Messages that fail with a
+        transient error are retried with exponential backoff; the daily sending
+        limit is not retried. A batch that fails in transport records the error
+        for each of its messages, without retrying, as they may have been sent.
+
+        Attachments are sent inline in the batch requests, so they should be small.
+
+        Args:
+            messages (list): dicts with the sendMessage arguments: to, subject, message and
+                optionally type, attachments and compress
+            batch_size (int): maximum messages sent in each batch request, at most 100,
+                further limited by the quota_burst_units given to the constructor
+            retries (int): times a message failing with a transient error is retried
+
+        Returns:
+            list: one dict per message, in the given order, with the "id" of the
+                sent message or the "error" that made it fail.
+        """
+        payloads = [self._createMessage(message['to'], message['subject'], message['message'],
+                                        message.get('type', 'plain'), message.get('attachments'),
+                                        message.get('compress', False)) for message in messages]
+        batch_size = max(1, min(batch_size, int(self._rateLimiter.capacity // Mail.SEND_QUOTA_UNITS)))
+        results = [None] * len(payloads)
+        pending = list(range(len(payloads)))
+        for attempt in range(retries + 1):
+            retry = []
+
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if exception is None:
+                    results[index] = {'id': response.get('id'), 'error': None}
+                elif attempt < retries and self._isTransient(exception):
+                    retry.append(index)
+                else:
+                    results[index] = {'id': None, 'error': exception}
+
+            for start in range(0, len(pending), batch_size):
+                indexes = pending[start:start + batch_size]
+                batch = self._gmailService.new_batch_http_request(callback=callback)
+                for index in indexes:
+                    batch.add(self._gmailService.users().messages().send(userId='me', body=payloads[index]),
+                              request_id=str(index))
+                self._rateLimiter.acquire(len(indexes) * Mail.SEND_QUOTA_UNITS)
+                try:
+                    self._ensureToken()
+                    batch.execute()
+                except Exception as error:
+                    for index in indexes:
+                        if results[index] is None and index not in retry:
+                            callback(str(index), None, error)
+            if not retry:
+                break
+            pending = sorted(retry)
+            time.sleep(min(2 ** attempt, 64) + random.random())
+        return results
+
+    def _ensureToken(self):
+        """Refresh the shared token under its lock before a batch signs its requests with it."""
+        http = getattr(self._gmailService, '_http', None)
+        if isinstance(http, utilities.PooledHttp) and http.credentials is not None:
+            http.ensure_token()
+
+    @staticmethod
+    def _isTransient(error):
+        """Check if a failed request is worth retrying."""
+        if not isinstance(error, errors.HttpError):
+            return False
+        try:
+            content = json.loads(error.content.decode('utf-8'))
+            reasons = [detail.get('reason') for detail in content.get('error', {}).get('errors', [])]
+        except ValueError:
+            reasons = []
+        if any(reason in Mail.FATAL_REASONS for reason in reasons):
+            return False
+        if error.resp.status in Mail.RETRY_STATUS:
+            return True
+        return any(reason in Mail.RETRY_REASONS for reason in reasons)
@@ -0,0 +1,129 @@
+"""Pipeline module.
+
+This module moves Analytics reports into BigQuery tables without
+going through the report cache or pandas.
+"""
+__author__ = 'Metriplica-Ayyoub'
+
+import json
+import logging
+import threading
+from queue import Queue
+from tempfile import SpooledTemporaryFile
+from pykemen.utilities import LazyModule
+
+bigquery = LazyModule("google.cloud.bigquery")
+
+logger = logging.getLogger("Pipeline")
+logger.setLevel(logging.WARNING)
+
+ANALYTICS_TYPES = {
+    "INTEGER": ("INTEGER", int),
+    "FLOAT": ("FLOAT", float),
+    "CURRENCY": ("FLOAT", float),
+    "PERCENT": ("FLOAT", float),
+    "TIME": ("FLOAT", float),
+    "STRING": ("STRING", lambda value: value),
+}
+
+# Rows of a chunk are kept in memory up to this size, then spilled to disk.
+SPOOL_SIZE = 64 * 1024 * 1024
+# Appended chunks are loaded once they reach this size.
+LOAD_SIZE = 1024 * 1024 * 1024
+
+
+def schema_from_headers(column_headers):
+    """Build a BigQuery schema from the column headers of an Analytics response.
+
+    The "ga:" prefix is removed from the column names.
+
+    Args:
+        column_headers (list): columnHeaders of an Analytics response
+
+    Returns:
+        tuple: list of bigquery.SchemaField and list of value converters, in column order
+    """
+    schema = []
+    converters = []
+    for header in column_headers:
+        type_, converter = ANALYTICS_TYPES.get(header.get("dataType"), ANALYTICS_TYPES["STRING"])
+        schema.append(bigquery.SchemaField(header["name"].replace("ga:", ""), type_))
+        converters.append(converter)
+    return schema, converters
+
+
+def analytics_to_bigquery(analytics, bigquery_manager, project_id, dataset_id, table_id, unsampled=True,
+                          append=False, queue_size=4, load_size=LOAD_SIZE, **kwargs):
+    """Load an Analytics report into a BigQuery table.
+
+    Report pages are serialized once to newline delimited JSON and loaded
+    by a background thread while the next pages are downloaded. With
+    unsampled reports each day is loaded into its own table$YYYYMMDD
+    partition, otherwise the whole report is loaded into the table. Each
+    overwrite is a single load job, so a failure never leaves a table or
+    partition half written; when appending, chunks are loaded as soon as
+    they reach load_size.
+
+    Args:
+        analytics (Analytics): manager used to download the report
+        bigquery_manager (BigQuery): manager used to load the data
+        project_id (str): BigQuery project id
+        dataset_id (str): dataset of the table
+        table_id (str): table to load the report to, created if needed
+        unsampled (boolean): True will download and load the report day by day
+        append (boolean): True to append to the table or partitions instead of overwriting them
+        queue_size (int): downloaded chunks waiting to be loaded before the download blocks
+        load_size (int): bytes of JSON after which an appended chunk is loaded
+        kwargs (**dict): Analytics report configuration variable with all required parameters
+
+    Returns:
+        bool: True for success, Raises an error otherwise.
+    """
+    chunks = Queue(maxsize=queue_size)
+    errors = []
+
+    def load():
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            data, schema, partition, append_chunk = chunk
+            try:
+                if not errors:
+                    bigquery_manager.load_json(project_id, dataset_id, table_id, data, schema,
+                                               partition=partition, append=append_chunk)
+                    logger.info("Loaded {table} {partition}".format(table=table_id, partition=partition or ""))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                data.close()
+
+    loader = threading.Thread(target=load)
+    loader.daemon = True
+    loader.start()
+    try:
+        schema = converters = names = None
+        data = current_date = None
+        for date, report in analytics.iter_report_pages(unsampled=unsampled, **kwargs):
+            if errors:
+                break
+            if schema is None:
+                schema, converters = schema_from_headers(report.get("columnHeaders", []))
+                names = [field.name for field in schema]
+            if data is not None and (date != current_date or (append and data.tell() >= load_size)):
+                chunks.put((data, schema, current_date, append))
+                data = None
+            if data is None:
+                data = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+                current_date = date
+            for row in report.get("rows", []):
+                record = dict((name, convert(value)) for name, convert, value in zip(names, converters, row))
+                data.write(json.dumps(record).encode("utf-8") + b"\n")
+        if data is not None:
+            chunks.put((data, schema, current_date, append))
+    finally:
+        chunks.put(None)
+        loader.join()
+    if errors:
+        raise errors[0]
+    return True
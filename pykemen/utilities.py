@@ -1,11 +1,48 @@
+import datetime
+import importlib
 import json
 import webbrowser
-import httplib2
-from googleapiclient.discovery import build
-from oauth2client import client
 import os
+import socket
+import threading
+import time
+import types
 from builtins import input
 
+
+class LazyModule(types.ModuleType):
+    """Module placeholder that imports the real module on first attribute access."""
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+httplib2 = LazyModule("httplib2")
+discovery = LazyModule("googleapiclient.discovery")
+errors = LazyModule("googleapiclient.errors")
+client = LazyModule("oauth2client.client")
+google_auth = LazyModule("google.auth")
+google_auth_requests = LazyModule("google.auth.transport.requests")
+requests_adapters = LazyModule("requests.adapters")
+
+POOL_SIZE = 10
+HTTP_TIMEOUT = 60
+
+DISCOVERY_CACHE_DIR = os.environ.get(
+    "PYKEMEN_DISCOVERY_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "pykemen", "discovery"))
+DISCOVERY_CACHE_MAX_AGE = 24 * 60 * 60
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+_shared_credentials = {}
+_credentials_locks = {}
+_shared_transports = {}
+_shared_default_credentials = {}
+_shared_sessions = {}
+_shared_lock = threading.RLock()
+
+
 def saveJson(filename, object):
     with open(filename, 'w') as f:
         json.dump(object, f)
@@ -18,26 +55,296 @@ def openJson(filename):
 
 
 def getCredentials(secrets, credentials, scopes):
-    if not os.path.isfile(credentials):
-        flow = client.flow_from_clientsecrets(
-                secrets,
-                scope=scopes,
-                redirect_uri='urn:ietf:wg:oauth:2.0:oob')
-        auth_uri = flow.step1_get_authorize_url()
-        print("Auth url: {}".format(auth_uri))
-        webbrowser.open(auth_uri)
-        auth_code = input('Enter the auth code: ')
-        cre = flow.step2_exchange(auth_code)
-        saveJson(credentials,cre.to_json())
-    else:
-        cre = client.Credentials.new_from_json(openJson(credentials))
-    return cre
+    """Load the oauth credentials of a file, running the auth flow if it does not exist.
+
+    Credentials are loaded once per file and shared by the whole process.
+    The auth flow only holds the lock of its own credentials file.
+    """
+    with _shared_lock:
+        if credentials in _shared_credentials:
+            return _shared_credentials[credentials]
+        lock = _credentials_locks.setdefault(credentials, threading.Lock())
+    with lock:
+        with _shared_lock:
+            if credentials in _shared_credentials:
+                return _shared_credentials[credentials]
+        if not os.path.isfile(credentials):
+            flow = client.flow_from_clientsecrets(
+                    secrets,
+                    scope=scopes,
+                    redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+            auth_uri = flow.step1_get_authorize_url()
+            print("Auth url: {}".format(auth_uri))
+            webbrowser.open(auth_uri)
+            auth_code = input('Enter the auth code: ')
+            cre = flow.step2_exchange(auth_code)
+            saveJson(credentials,cre.to_json())
+        else:
+            cre = client.Credentials.new_from_json(openJson(credentials))
+        with _shared_lock:
+            _shared_credentials[credentials] = cre
+        return cre
+
+
+def get_http(secrets, credentials, scopes):
+    """Authorized PooledHttp shared by every client using the same credentials file."""
+    with _shared_lock:
+        if credentials in _shared_transports:
+            return _shared_transports[credentials]
+    cre = getCredentials(secrets, credentials, scopes)
+    with _shared_lock:
+        return _shared_transports.setdefault(credentials, PooledHttp(cre))
+
+
+def build_http(**kwargs):
+    """httplib2.Http configured like googleapiclient.http.build_http.
+
+    308 is not followed as a redirect, as it is the "Resume Incomplete" answer
+    of resumable uploads, and requests time out after the socket default
+    timeout or HTTP_TIMEOUT seconds.
+
+    Args:
+        kwargs (**dict): arguments of httplib2.Http
+
+    Returns:
+        httplib2.Http
+    """
+    kwargs.setdefault('timeout', socket.getdefaulttimeout() or HTTP_TIMEOUT)
+    http = httplib2.Http(**kwargs)
+    if hasattr(http, 'redirect_codes'):
+        http.redirect_codes = http.redirect_codes - set([308])
+    return http
+
+
+def create_session(scopes=None, pool_size=POOL_SIZE):
+    """Authorized requests session with the application default credentials.
+
+    The credentials are loaded once per scopes and the sessions are shared by
+    every client asking for the same scopes and pool size.
+
+    Args:
+        scopes (list): oauth scopes of the credentials
+        pool_size (int): connections kept alive per host
+
+    Returns:
+        google.auth.transport.requests.AuthorizedSession
+    """
+    scopes = tuple(scopes) if scopes else None
+    with _shared_lock:
+        if (scopes, pool_size) not in _shared_sessions:
+            if scopes not in _shared_default_credentials:
+                _shared_default_credentials[scopes], _ = google_auth.default(scopes=scopes)
+            session = google_auth_requests.AuthorizedSession(_shared_default_credentials[scopes])
+            adapter = requests_adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _shared_sessions[(scopes, pool_size)] = session
+        return _shared_sessions[(scopes, pool_size)]
+
+
+def get_discovery_document(api_name, api_version):
+    """Discovery document of an API, cached in process and on disk.
+
+    Cached documents are used for DISCOVERY_CACHE_MAX_AGE seconds. Older or
+    invalid documents are downloaded again, but a stale document is still
+    used if the download fails, so APIs used before can be built offline.
+
+    Args:
+        api_name (str): name of the API, e.g. analytics
+        api_version (str): version of the API, e.g. v3
+
+    Returns:
+        str: JSON discovery document
+    """
+    key = (api_name, api_version)
+    with _discovery_lock:
+        cached = _discovery_documents.get(key)
+        if cached and time.time() - cached[0] < DISCOVERY_CACHE_MAX_AGE:
+            return cached[1]
+        path = os.path.join(DISCOVERY_CACHE_DIR, "{}.{}.json".format(api_name, api_version))
+        stale = cached[1] if cached else None
+        try:
+            with open(path, 'r') as f:
+                document = f.read()
+            json.loads(document)
+            modified = os.path.getmtime(path)
+            if time.time() - modified < DISCOVERY_CACHE_MAX_AGE:
+                _discovery_documents[key] = (modified, document)
+                return document
+            stale = document
+        except (IOError, OSError, ValueError):
+            pass
+        try:
+            document = _fetch_discovery_document(api_name, api_version)
+        except (errors.HttpError, httplib2.HttpLib2Error, IOError, OSError, ValueError):
+            if stale is None:
+                raise
+            document = stale
+        else:
+            _save_discovery_document(path, document)
+        _discovery_documents[key] = (time.time(), document)
+        return document
+
+
+def _save_discovery_document(path, document):
+    partial = "{}.{}".format(path, os.getpid())
+    try:
+        if not os.path.isdir(DISCOVERY_CACHE_DIR):
+            os.makedirs(DISCOVERY_CACHE_DIR)
+        with open(partial, 'w') as f:
+            f.write(document)
+        if os.path.isfile(path):
+            os.remove(path)
+        os.rename(partial, path)
+    except (IOError, OSError):
+        if os.path.isfile(partial):
+            os.remove(partial)
+
+
+def _fetch_discovery_document(api_name, api_version):
+    for uri in (discovery.DISCOVERY_URI, discovery.V2_DISCOVERY_URI):
+        uri = uri.format(api=api_name, apiVersion=api_version)
+        resp, content = build_http().request(uri)
+        if resp.status == 404:
+            continue
+        if resp.status >= 400:
+            raise errors.HttpError(resp, content, uri=uri)
+        document = content.decode("utf-8")
+        json.loads(document)
+        return document
+    raise errors.UnknownApiNameOrVersion("name: {} version: {}".format(api_name, api_version))
 
 
 def create_api(api_name, api_version, scopes=None, secrets=None, credentials=None):
+    document = get_discovery_document(api_name, api_version)
     if None in (secrets, credentials, scopes):
-        return build(api_name, api_version)
+        return discovery.build_from_document(document)
     # else:
     #     raise ValueError("The variables {}, {} and {} should not be empty if there is no SA available!".format(scopes, secrets, credentials))
-    http_auth = getCredentials(secrets, credentials, scopes).authorize(httplib2.Http())
-    return build(api_name, api_version, http=http_auth)
+    return discovery.build_from_document(document, http=get_http(secrets, credentials, scopes))
+
+
+class PooledHttp(object):
+    """Thread-safe httplib2 transport authorized with oauth2client credentials.
+
+    httplib2.Http is not thread-safe, so every thread gets its own instance,
+    built with build_http, which keeps its connections alive between requests. The credentials are
+    shared by all the threads and refreshed only once when the token expires.
+    """
+    REFRESH_STATUS_CODES = (401,)
+    REFRESH_MARGIN = 60
+
+    def __init__(self, credentials=None, **kwargs):
+        """Constructor for PooledHttp class.
+
+        Args:
+            credentials (oauth2client.client.Credentials): credentials to authorize the requests
+            kwargs (**dict): arguments of build_http for the httplib2.Http of each thread
+
+        Returns:
+            PooledHttp
+        """
+        self.credentials = credentials
+        self._kwargs = kwargs
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self._http(), attr)
+
+    def _http(self):
+        """httplib2.Http of the current thread."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = build_http(**self._kwargs)
+        return http
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        """Send a request through the connection of the current thread, same arguments as httplib2.Http.request."""
+        if self.credentials is None:
+            return self._http().request(uri, method, body=body, headers=headers, **kwargs)
+        position = body.tell() if hasattr(body, 'tell') else None
+        token = self.ensure_token()
+        resp, content = self._authorized_request(token, uri, method, body, headers, kwargs)
+        if resp.status in PooledHttp.REFRESH_STATUS_CODES:
+            token = self._refresh(token)
+            if position is not None:
+                body.seek(position)
+            resp, content = self._authorized_request(token, uri, method, body, headers, kwargs)
+        return resp, content
+
+    def ensure_token(self):
+        """Valid access token of the shared credentials, refreshed under the lock if it is about to expire.
+
+        Call it before code that signs requests with the credentials by itself,
+        like googleapiclient batch requests.
+
+        Returns:
+            str: access token, None without credentials
+        """
+        if self.credentials is None:
+            return None
+        token = self.credentials.access_token
+        if not token or self._expiring():
+            token = self._refresh(token)
+        return token
+
+    def _expiring(self):
+        """Check if the token is expired or expires within REFRESH_MARGIN seconds."""
+        if self.credentials.access_token_expired:
+            return True
+        expiry = getattr(self.credentials, 'token_expiry', None)
+        margin = datetime.timedelta(seconds=PooledHttp.REFRESH_MARGIN)
+        return expiry is not None and datetime.datetime.utcnow() + margin >= expiry
+
+    def _authorized_request(self, token, uri, method, body, headers, kwargs):
+        headers = dict(headers or {})
+        headers['Authorization'] = 'Bearer ' + token
+        return self._http().request(uri, method, body=body, headers=headers, **kwargs)
+
+    def _refresh(self, stale_token):
+        """Refresh the shared token, unless another thread already replaced the stale one."""
+        with self._refresh_lock:
+            if self.credentials.access_token == stale_token or self._expiring():
+                self.credentials.refresh(self._http())
+            return self.credentials.access_token
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter, safe to share between threads."""
+
+    def __init__(self, rate, capacity=None):
+        """Constructor for TokenBucket class.
+
+        Args:
+            rate (float): tokens added to the bucket per second
+            capacity (float): maximum tokens in the bucket, rate by default
+
+        Returns:
+            TokenBucket
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, waiting until they are available.
+
+        Args:
+            tokens (float): tokens to take, at most the capacity of the bucket
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)